@@ -1,152 +1,279 @@
 import os
 import json
-import pandas as pd
-import qrcode
-import traceback
+import hashlib
+import io
+import pathlib
+import tempfile
+import segno
+import logging
 import asyncio
-from flask import Flask, request
+import concurrent.futures
+import sqlite3
+from collections import OrderedDict
+import aiofiles
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, CallbackContext
+from telegram.constants import MessageLimit
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, CallbackContext
+from telegram.request import HTTPXRequest
+
+# ✅ INFO in production; set LOG_LEVEL=DEBUG to trace every update
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+logging.getLogger("httpx").setLevel(logging.WARNING)  # ✅ httpx logs every request URL, bot token included
+logger = logging.getLogger(__name__)
 
 # ✅ Load bot token
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GROUP_ID = -1002253157550  # Replace with your group chat ID
 
-os.makedirs("qrcodes", exist_ok=True)
-GUESTS_FILE = "guests.json"
-
-# ✅ Initialize Flask app
-flask_app = Flask(__name__)
-
-# ✅ Ensure single event loop & correct async execution
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+QR_DIR = pathlib.Path("qrcodes")
+QR_DIR.mkdir(parents=True, exist_ok=True)
+_UMASK = os.umask(0)  # read once at startup (os.umask can only be read by setting it)
+os.umask(_UMASK)
+GUESTS_FILE = "guests.json"  # legacy storage, imported into GUESTS_DB on first start
+GUESTS_DB = "guests.db"
+ADD_GUEST = "➕ Add Guest"
+SHOW_GUESTS = "📋 Show Guests"
+CHECKED = "✅ Checked In"
+NOT_CHECKED = "❌ Not Checked In"
+MESSAGE_LIMIT = 4000  # Telegram rejects messages over 4096 chars; leave room for the header
+# ✅ Fixed error level and mask: skips the per-code mask search, any mask scans fine
+QR_OPTIONS = {"error": "L", "boost_error": False, "mask": 0}
+QR_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+QR_BYTES_CACHE_SIZE = 256  # PNGs are ~1 KB, so this LRU stays small
+_qr_bytes = OrderedDict()
+NOTIFY_Q: asyncio.Queue = asyncio.Queue()  # guest names awaiting a group notification
+NOTIFY_BATCH_SIZE = 20
+NOTIFY_DRAIN_TIMEOUT = 5  # seconds
+_notifier_task = None
 
-async def initialize_bot():
-    """Ensures the bot is properly initialized before handling updates."""
-    global app  # Declare as global to prevent re-initialization issues
-    app = Application.builder().token(TOKEN).build()
-    await app.initialize()
-    print("✅ Telegram bot initialized!")
+async def on_startup(application):
+    """Starts background workers once the bot is initialized."""
+    global _notifier_task
+    _notifier_task = asyncio.create_task(_notifier_worker())
+    logger.info("✅ Telegram bot initialized!")
 
-loop.run_until_complete(initialize_bot())  # ✅ Properly initialize before Flask starts
+async def on_stop(application):
+    """Gives queued group notifications a chance to go out before the bot shuts down."""
+    try:
+        await asyncio.wait_for(NOTIFY_Q.join(), timeout=NOTIFY_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("⚠️ Dropping %s unsent group notifications.", NOTIFY_Q.qsize())
+    _notifier_task.cancel()
 
-@flask_app.route("/", methods=["GET"])
-def index():
-    return "✅ Bot is running!", 200  # ✅ Flask working test
+# ✅ One pooled HTTP/2 client shares TLS sessions across outbound API calls; the
+#    rate limiter keeps bursts under Telegram's 30 msg/s cap instead of retry-storming
+app = (
+    Application.builder()
+    .token(TOKEN)
+    .request(HTTPXRequest(http_version="2", connection_pool_size=64, pool_timeout=30))
+    .get_updates_request(HTTPXRequest(http_version="2"))
+    .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
+    .concurrent_updates(256)  # ✅ One user's QR render doesn't hold up another's /start
+    .post_init(on_startup)
+    .post_stop(on_stop)
+    .build()
+)
 
-@flask_app.route(f"/{TOKEN}", methods=["POST"])
-async def webhook():
-    """Handles incoming Telegram updates"""
-    print("🟢 Incoming Webhook Request!")
+def _open_db():
+    conn = sqlite3.connect(GUESTS_DB, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS guests ("
+            "name TEXT PRIMARY KEY, qr_file TEXT NOT NULL, checked_in INTEGER NOT NULL DEFAULT 0)"
+        )
+    _import_guest_file(conn)
+    return conn
 
-    try:
-        update = request.get_json()
-        print(f"🔹 DEBUG: Full update from Telegram:\n{json.dumps(update, indent=2)}")  # ✅ Log raw data
+def _import_guest_file(conn):
+    """One-time migration of the legacy guests.json into an empty table."""
+    if not os.path.exists(GUESTS_FILE) or conn.execute("SELECT 1 FROM guests LIMIT 1").fetchone():
+        return
+    with open(GUESTS_FILE, "r", encoding="utf-8") as file:
+        try:
+            guests = json.load(file)
+        except json.JSONDecodeError:
+            return
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO guests (name, qr_file, checked_in) VALUES (?, ?, ?)",
+            [(name, data["qr_file"], int(data["checked_in"])) for name, data in guests.items()],
+        )
 
-        if update:
-            try:
-                if "message" not in update:
-                    print("⚠️ WARNING: Received update without 'message' field.")
-                    return "No message field", 200
+def get_qr_file(name):
+    row = conn.execute("SELECT qr_file FROM guests WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
 
-                telegram_update = Update.de_json(update, app.bot)
+def add_guest(name, qr_file):
+    """Like dict.setdefault: an existing row (and its check-in state) is left untouched."""
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO guests (name, qr_file, checked_in) VALUES (?, ?, 0)", (name, qr_file))
 
-                await app.process_update(telegram_update)  # ✅ Direct async processing
+def iter_guests():
+    return conn.execute("SELECT name, checked_in FROM guests")
 
-            except KeyError as e:
-                print(f"❌ ERROR: Missing expected key: {e}")
-                print(traceback.format_exc())  # ✅ Print full error traceback for debugging
-                return "Internal Server Error", 500
+conn = _open_db()
 
-        print("✅ Webhook Processed Update Successfully!")
-        return "OK", 200
+def qr_path(qr_data):
+    """Files are keyed by payload hash, so identical codes share one PNG."""
+    digest = hashlib.blake2b(qr_data.encode(), digest_size=12).hexdigest()
+    return str(QR_DIR / f"{digest}.png")
 
-    except Exception as e:
-        print(f"❌ ERROR: {e}")
-        print(traceback.format_exc())  # ✅ Print full error traceback
-        return "Internal Server Error", 500
+def _render_qr(qr_data, qr_filename):
+    """Blocking QR encode + PNG write; runs in QR_POOL, never on the event loop.
 
-def load_guest_list():
-    if os.path.exists(GUESTS_FILE):
-        with open(GUESTS_FILE, "r", encoding="utf-8") as file:
-            try:
-                return json.load(file)
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-def save_guest_list(data):
-    with open(GUESTS_FILE, "w", encoding="utf-8") as file:
-        json.dump(data, file, indent=2)
+    segno writes the PNG itself (no PIL rasterization); the bytes are returned so the
+    reply that follows doesn't read the file back from disk.
+    """
+    buffer = io.BytesIO()
+    segno.make(qr_data, micro=False, **QR_OPTIONS).save(buffer, kind="png", scale=5)
+    data = buffer.getvalue()
+    # ✅ Write to a private temp file and swap it in, so the reuse check in generate_qr
+    #    never sees a half-written PNG (crash mid-write or two concurrent adds)
+    fd, tmp_file = tempfile.mkstemp(dir=QR_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.chmod(tmp_file, 0o666 & ~_UMASK)  # ✅ mkstemp is 0600; match what open() would create
+        os.replace(tmp_file, qr_filename)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+    return data
 
 async def generate_qr(name):
-    guests = load_guest_list()
-    if name in guests:
-        return guests[name]["qr_file"]
+    existing = get_qr_file(name)
+    if existing:
+        return existing
 
     qr_data = f"Guest: {name}"
-    qr_code = qrcode.make(qr_data)
-    qr_filename = f"qrcodes/{name.replace(' ', '_')}.png"
-    qr_code.save(qr_filename)
+    qr_filename = qr_path(qr_data)
+    if not os.path.exists(qr_filename):
+        data = await asyncio.get_running_loop().run_in_executor(QR_POOL, _render_qr, qr_data, qr_filename)
+        _cache_qr(qr_filename, data)
 
-    guests[name] = {"qr_file": qr_filename, "checked_in": False}
-    save_guest_list(guests)
+    add_guest(name, qr_filename)  # ✅ DB writes stay on the loop thread
     return qr_filename
 
-async def save_guest_to_group(name):
-    message = f"📝 Guest Added: {name} | Status: Not Checked In"
-    await app.bot.send_message(chat_id=GROUP_ID, text=message)
+async def read_qr(qr_file):
+    """Returns the PNG bytes for qr_file, serving recently sent codes from memory."""
+    data = _qr_bytes.get(qr_file)
+    if data is not None:
+        _qr_bytes.move_to_end(qr_file)
+        return data
+    async with aiofiles.open(qr_file, "rb") as file:
+        data = await file.read()
+    _cache_qr(qr_file, data)
+    return data
+
+def _cache_qr(qr_file, data):
+    _qr_bytes[qr_file] = data
+    if len(_qr_bytes) > QR_BYTES_CACHE_SIZE:
+        _qr_bytes.popitem(last=False)
+
+def chunk_lines(lines, limit=MESSAGE_LIMIT):
+    """Joins lines into messages that each fit under Telegram's length cap."""
+    chunk, size = [], 0
+    for line in lines:
+        if chunk and size + len(line) + 1 > limit:
+            yield "\n".join(chunk)
+            chunk, size = [], 0
+        chunk.append(line)
+        size += len(line) + 1
+    if chunk:
+        yield "\n".join(chunk)
+
+async def save_guest_to_group(names):
+    """Sends one group message per chunk so a large batch never exceeds Telegram's length cap."""
+    for message in chunk_lines(f"📝 Guest Added: {name} | Status: Not Checked In" for name in names):
+        try:
+            await app.bot.send_message(chat_id=GROUP_ID, text=message)
+        except Exception as e:
+            logger.exception("❌ Failed to notify group: %s\n%s", e, message)
+
+async def _notifier_worker():
+    """Drains NOTIFY_Q, folding names queued in the meantime into as few group messages as fit."""
+    while True:
+        names = [await NOTIFY_Q.get()]
+        while len(names) < NOTIFY_BATCH_SIZE and not NOTIFY_Q.empty():
+            names.append(NOTIFY_Q.get_nowait())
+        try:
+            await save_guest_to_group(names)
+        finally:
+            for _ in names:
+                NOTIFY_Q.task_done()
 
 async def start(update: Update, context: CallbackContext):
-    print(f"🚀 /start command received from user: {update.message.chat.id}")  # ✅ Log user ID
+    logger.debug("🚀 /start command received from user: %s", update.message.chat.id)  # ✅ Log user ID
+
+    await update.message.reply_text("Welcome to Guest Manager!", reply_markup=MENU_MARKUP)
+
+    logger.debug("✅ Sent start message successfully!")  # ✅ Log response
 
-    keyboard = [[KeyboardButton("➕ Add Guest")], [KeyboardButton("📋 Show Guests")]]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+async def _on_add(update: Update, context: CallbackContext):
+    # ✅ Set before the prompt round-trip: with concurrent updates a fast reply can arrive first
+    context.user_data["awaiting_name"] = True
+    await update.message.reply_text("✍️ Enter guest name:")
 
-    await update.message.reply_text("Welcome to Guest Manager!", reply_markup=reply_markup)
+async def _on_show(update: Update, context: CallbackContext):
+    sent = False
+    for chunk in chunk_lines(f"{name} - {CHECKED if checked_in else NOT_CHECKED}"
+                             for name, checked_in in iter_guests()):
+        await update.message.reply_text(chunk if sent else f"Guest List:\n{chunk}")
+        sent = True
+    if not sent:
+        await update.message.reply_text("No guests found.")
 
-    print("✅ Sent start message successfully!")  # ✅ Log response
+async def _on_new_name(update: Update, context: CallbackContext, name):
+    qr_file = await generate_qr(name)
+    # ✅ Queued before replying, so a failed send to the user doesn't also skip the group
+    NOTIFY_Q.put_nowait(name)  # ✅ Group bookkeeping happens off the user's critical path
+    photo = await read_qr(qr_file)
+    caption = f"✅ {name} added! Here is the QR Code."
+    if len(caption) <= MessageLimit.CAPTION_LENGTH:
+        await update.message.reply_photo(photo=photo, caption=caption)
+    else:  # ✅ Very long names don't fit a caption; fall back to a separate text message
+        await update.message.reply_text(caption)
+        await update.message.reply_photo(photo=photo)
+
+# ✅ Menu text → handler, built once; dispatch is a single dict lookup
+ROUTES = {ADD_GUEST: _on_add, SHOW_GUESTS: _on_show}
+MENU_MARKUP = ReplyKeyboardMarkup([[KeyboardButton(ADD_GUEST)], [KeyboardButton(SHOW_GUESTS)]],
+                                  resize_keyboard=True)
 
 async def handle_message(update: Update, context: CallbackContext):
     text = update.message.text.strip()
 
-    if text == "➕ Add Guest":
-        await update.message.reply_text("✍️ Enter guest name:")
-        context.user_data["awaiting_name"] = True
-    elif text == "📋 Show Guests":
-        guests = load_guest_list()
-        if not guests:
-            await update.message.reply_text("No guests found.")
-        else:
-            guest_list = "\n".join(
-                [f"{name} - {'✅ Checked In' if data['checked_in'] else '❌ Not Checked In'}" for name, data in
-                 guests.items()])
-            await update.message.reply_text(f"Guest List:\n{guest_list}")
-    elif context.user_data.get("awaiting_name"):
-        context.user_data["awaiting_name"] = False
-        qr_file = await generate_qr(text)
-        await update.message.reply_text(f"✅ {text} added! Here is the QR Code.")
-        with open(qr_file, "rb") as photo:
-            await update.message.reply_photo(photo=photo)
-        await save_guest_to_group(text)
-    else:
-        await update.message.reply_text("❌ Invalid option.")
+    handler = ROUTES.get(text)
+    if handler:
+        return await handler(update, context)
+    if context.user_data.pop("awaiting_name", False):
+        return await _on_new_name(update, context, text)
+    await update.message.reply_text("❌ Invalid option.")
 
-# ✅ Register handlers only after bot is initialized
+# ✅ Register handlers before any runner starts the bot
 app.add_handler(CommandHandler("start", start))
-print("✅ Command handlers registered!")
+logger.info("✅ Command handlers registered!")
 app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-print("🟢 Bot is initializing...")  # Debugging message
+logger.info("🟢 Bot is initializing...")
 
-# ✅ Run Flask app (Webhook Mode)
-if "PORT" in os.environ:  
-    PORT = int(os.getenv("PORT", 8443))
-    print(f"🌍 Running Webhook on port {PORT}...")
-    flask_app.run(host="0.0.0.0", port=PORT)  # ✅ Production Flask server
-else:
-    print("🔄 Running Polling mode...")
-    loop.run_until_complete(app.run_polling())
+# ✅ Handlers read update.message, so only plain messages are delivered (edits etc. are dropped)
+ALLOWED_UPDATES = [Update.MESSAGE]
+
+if __name__ == "__main__":
+    # ✅ PTB owns the event loop, webhook server and graceful shutdown in both modes
+    if "PORT" in os.environ:
+        PORT = int(os.getenv("PORT", 8443))
+        WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
+        if not WEBHOOK_URL:
+            raise SystemExit("WEBHOOK_URL is not set (and RENDER_EXTERNAL_URL is unavailable)")
+        logger.info("🌍 Running Webhook on port %s...", PORT)
+        app.run_webhook(listen="0.0.0.0", port=PORT, url_path=TOKEN, webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+                        allowed_updates=ALLOWED_UPDATES)
+    else:
+        logger.info("🔄 Running Polling mode...")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
-print("✅ Bot is running...")  # Should appear in Render logs
+    logger.info("✅ Bot stopped.")